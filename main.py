@@ -1,12 +1,37 @@
-import csv
 import os
 import logging
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
 from contextlib import ExitStack
+from functools import partial
 from getopt import getopt, GetoptError
 
 import sys
 from tqdm import tqdm
-from werkzeug.datastructures import MultiDict
+
+# columns of bills output in their order
+Header = namedtuple('Header', [
+    'id', 'date', 'salesman', 'price_without_vat', 'vat_amount', 'adjustment', 'payment_type', 'cash_id',
+    'total_price',
+])
+Bill = namedtuple('Bill', ['type', 'vat_id', 'header', 'items'])
+
+# output is written in binary mode, keep the platform line endings of text mode
+HEADER_FORMAT = (';'.join(['{}'] * len(Header._fields)) + os.linesep).format
+ITEM_FORMAT = ('{};{};{};{};{}' + os.linesep).format
+OUTPUT_BUFFER_SIZE = 1 << 20
+READ_AHEAD_FILES = 4
+
+# slots of tags in rows of one bill, single row tags keep their first row, ADJI and SI keep all rows
+DOCHDR, RCPID, TAXI, TTL, TNDR, RCPDT, ECRDESCR, ADJI, SI = range(9)
+SLOTS = {
+    'DOCHDR': DOCHDR, 'RCPID': RCPID, 'TAXI': TAXI, 'TTL': TTL, 'TNDR': TNDR, 'RCPDT': RCPDT,
+    'ECRDESCR': ECRDESCR, 'ADJI': ADJI, 'SI': SI,
+}
+
+logger = logging.getLogger(__name__)
 
 
 def read_folder(basename, yyyy, mm):
@@ -15,86 +40,193 @@ def read_folder(basename, yyyy, mm):
     :returns files with pattern yyyymmdd_Dat.csv
     """
     dirname = os.path.join(os.path.abspath(basename), yyyy, mm)
-    for dd in os.listdir(dirname):
-        f = os.path.join(dirname, dd, yyyy + mm + dd + '_Dat.csv')
-        if os.path.isfile(f):
-            yield f
+    with os.scandir(dirname) as entries:
+        for dd in entries:
+            if not dd.is_dir():
+                continue
+            f = os.path.join(dd.path, yyyy + mm + dd.name + '_Dat.csv')
+            if os.path.isfile(f):
+                yield f
+
+
+def read_ahead(filenames):
+    """
+    reads files in background thread, so reading overlaps with processing of previous file
+    :returns filename and future with file content
+    """
+    files = queue.Queue(maxsize=READ_AHEAD_FILES)
+
+    def read():
+        for filename in filenames:
+            content = Future()
+            try:
+                with open(filename, 'rb') as csv_file:
+                    content.set_result(csv_file.read())
+            except Exception as e:
+                content.set_exception(e)
+            files.put((filename, content))
+        files.put(None)
+
+    threading.Thread(target=read, daemon=True).start()
+    return iter(files.get, None)
 
 
 def parse_csv(filename):
     """
-    parses as regular csv
-    :returns lines for one bill
+    parses tab separated file, fields are never quoted
+    :returns rows of one bill indexed by SLOTS
     """
-    with open(filename, encoding='windows-1250') as csv_file:
-        reader = csv.reader(csv_file, delimiter='\t', quotechar='"')
-        bill_lines = []
-        for line in reader:
-            bill_lines.append(line)
-            # document starts with DOCTR
-            if line[0] == 'DOCTR':
-                yield bill_lines
-                bill_lines = []
+    with open(filename, 'rb') as csv_file:
+        return parse_csv_from_bytes(csv_file.read())
 
 
-def process_doc(lines):
+def parse_csv_from_bytes(data):
     """
-    processes lines
+    parses content of tab separated file
+    :returns rows of one bill indexed by SLOTS
+    """
+    # only sales and refunds are written, file without them is not worth tokenizing
+    if b'SALES' not in data and b'REFUND' not in data:
+        return
+    # decode whole file at once instead of line by line in text mode
+    data = data.decode('windows-1250')
+    rows = [None] * ADJI + [[], []]
+    # normalize windows line endings in one pass instead of stripping '\r' per row,
+    # splitlines is not used as it also splits on form feed and record separators
+    for row in data.replace('\r\n', '\n').split('\n'):
+        line = row.split('\t')
+        tag = line[0]
+        # document ends with DOCTR
+        if tag == 'DOCTR':
+            yield rows
+            rows = [None] * ADJI + [[], []]
+            continue
+        slot = SLOTS.get(tag)
+        if slot is None:
+            continue
+        if slot >= ADJI:
+            rows[slot].append(line[1:])
+        elif rows[slot] is None:
+            rows[slot] = line[1:]
+
+
+def process_doc(rows):
+    """
+    processes rows of one bill
     :returns bill
     """
-    # change structure from [[key, ?, ?, ...?]] to associative dict(key, [?, ?, ...?])
-    lines = MultiDict([(line[0], line[1:]) for line in lines])
-    bill = {
-        'type': lines['DOCHDR'][1],
-        'id': lines['RCPID'][1] if 'RCPID' in lines else None,
-        'salesman': lines['RCPID'][0] if 'RCPID' in lines else None,
-        'total_price': lines['TTL'][0].replace('.', ',') if 'TTL' in lines else None,
-        'price_without_vat': lines['TAXI'][3].replace('.', ',') if 'TAXI' in lines else None,
-        'vat_amount': lines['TAXI'][4].replace('.', ',') if 'TAXI' in lines else None,
-        'adjustment': '{:.2f}'.format(sum(map(lambda x: float(x[3]), lines.getlist('ADJI')))).replace('.', ','),
-        'payment_type': lines['TNDR'][0] if 'TNDR' in lines else None,
-        'date': lines['RCPDT'][0] if 'RCPDT' in lines else None,
-        'cash_id': lines['ECRDESCR'][0] if 'ECRDESCR' in lines else None,
-        'vat_id': lines['ECRDESCR'][1] if 'ECRDESCR' in lines else None,
-    }
-    bill['items'] = _process_items(lines.getlist('SI'), lines.getlist('ADJI'), bill['type'] == 'REFUND')
-    return bill
+    dochdr = rows[DOCHDR]
+    rcpid = rows[RCPID]
+    ttl = rows[TTL]
+    taxi = rows[TAXI]
+    tndr = rows[TNDR]
+    rcpdt = rows[RCPDT]
+    ecrdescr = rows[ECRDESCR]
+    adjustments = rows[ADJI]
+    return Bill(
+        type=dochdr[1],
+        vat_id=ecrdescr[1] if ecrdescr else None,
+        header=Header(
+            id=rcpid[1] if rcpid else None,
+            salesman=rcpid[0] if rcpid else None,
+            total_price=ttl[0].replace('.', ',') if ttl else None,
+            price_without_vat=taxi[3].replace('.', ',') if taxi else None,
+            vat_amount=taxi[4].replace('.', ',') if taxi else None,
+            adjustment='{:.2f}'.format(sum(float(adj[3]) for adj in adjustments)).replace('.', ','),
+            payment_type=tndr[0] if tndr else None,
+            date=rcpdt[0] if rcpdt else None,
+            cash_id=ecrdescr[0] if ecrdescr else None,
+        ),
+        items=_process_items(rows[SI], adjustments, dochdr[1] == 'REFUND'),
+    )
 
 
 def _process_items(items, adjustments, refund):
-    sales = {adj[0]: adj[3] for adj in adjustments}
-    processed = []
+    """
+    generates items in output column order (item_id, amount, price, sale)
+    """
+    # only columns written to output get decimal comma, sales are converted once per adjustment
+    sales = {adj[0]: '-' + adj[3].replace('.', ',') for adj in adjustments}
     for item in items:
         order = item[1]
         storno = item[13]
         amount = item[6].replace('.', ',')
-        processed.append({
-            'order': order,
-            'item_id': item[2],
-            'title': item[3],
-            'price': item[4].replace('.', ','),
-            'price_total': item[5].replace('.', ','),
-            'amount': '-' + amount if storno == 'V' or refund else amount,
-            'unit': item[7],
-            'type': item[8],
-            'sale': '-' + sales[order].replace('.', ',') if order in sales else '0',
-        })
-    return processed
-
-
-def append_doc_to_csv(csv1, csv2, doc):
-    if doc['type'] != 'SALES' and doc['type'] != 'REFUND':
-        logger.info('skipping {}'.format(doc['type']))
+        yield (
+            item[2],
+            '-' + amount if storno == 'V' or refund else amount,
+            item[4].replace('.', ','),
+            sales.get(order, '0'),
+        )
+
+
+def append_doc_to_csv(bill_lines, item_lines, doc):
+    """
+    appends formatted output lines of sales and refunds, other documents are skipped
+    """
+    # missing or empty RCPID has no id to pair bill with its items
+    if doc.type not in ('SALES', 'REFUND') or not doc.header.id:
+        logger.info('skipping {} with RCPID {!r}'.format(doc.type, doc.header.id))
         return
 
-    if doc['id'] is '':
-        logger.info('RCPID is empty')
+    bill_lines.append(HEADER_FORMAT(*doc.header))
+
+    for item in doc.items:
+        item_lines.append(ITEM_FORMAT(doc.header.id, *item))
+
+
+def _process_file(filename):
+    """
+    processes one file, runs in worker process
+    :returns encoded bills, encoded items and number of processed documents
+    """
+    return _process_bills(parse_csv(filename))
+
+
+def _process_content(content):
+    """
+    processes file read by read_ahead
+    :returns encoded bills, encoded items and number of processed documents
+    """
+    return _process_bills(parse_csv_from_bytes(content.result()))
+
+
+def _process_bills(bills):
+    """
+    processes bills of one file
+    :returns encoded bills, encoded items and number of processed documents
+    """
+    # lines are collected in memory, encoded once and sent to main process as one block per file
+    bill_lines = []
+    item_lines = []
+    processed = 0
+    for rows in bills:
+        doc = process_doc(rows)
+        append_doc_to_csv(bill_lines, item_lines, doc)
+        processed += 1
+    return ''.join(bill_lines).encode('utf-8'), ''.join(item_lines).encode('utf-8'), processed
+
+
+def configure_logging():
+    """
+    sets up console logging, called in main process and in every worker process
+    """
+    # forked workers inherit configured logger, spawned ones (windows) start without handler
+    if logger.handlers:
         return
+    logger.setLevel(logging.DEBUG)
 
-    csv1.write('{id};{date};{salesman};{price_without_vat};{vat_amount};{adjustment};{payment_type};{cash_id};{total_price}\n'.format(**doc))
+    # create console handler and set level to debug
+    ch = logging.StreamHandler(stream=sys.stdout)
+    ch.setLevel(logging.DEBUG)
 
-    for item in doc['items']:
-        csv2.write('{id};{item_id};{amount};{price};{sale}\n'.format(id=doc['id'], **item))
+    # create formatter
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # add formatter to ch
+    ch.setFormatter(formatter)
+
+    # add ch to logger
+    logger.addHandler(ch)
 
 
 def split_datadir_arg(datadir):
@@ -106,7 +238,7 @@ def split_datadir_arg(datadir):
 
 
 def print_help():
-    print('main.py <data-directory> [--file=output-filename]')
+    print('main.py <data-directory> [--file=output-filename] [--jobs=number-of-processes]')
 
 
 def get_directory(argv):
@@ -123,10 +255,9 @@ def get_directory(argv):
 
 def main(argv):
     try:
-        argv = ['', 'test/2017/11']
         datadir = get_directory(argv)
         basedir, year, month = split_datadir_arg(datadir)
-        opts, args = getopt(argv[2:], 'hf:', ['help', 'file='])
+        opts, args = getopt(argv[2:], 'hf:j:', ['help', 'file=', 'jobs='])
     except IndexError:
         logger.exception('Please provide directory with data for month (basename/yyyy/mm)')
         print_help()
@@ -137,6 +268,7 @@ def main(argv):
         sys.exit(2)
 
     outputfile = '{}_{}'.format(year, month)
+    jobs = None
 
     for opt, arg in opts:
         if opt in ('-h', '--help'):
@@ -144,6 +276,14 @@ def main(argv):
             sys.exit(0)
         elif opt in ('-f', '--file'):
             outputfile = arg
+        elif opt in ('-j', '--jobs'):
+            try:
+                jobs = int(arg)
+                if jobs < 1:
+                    raise ValueError(arg)
+            except ValueError:
+                print_help()
+                sys.exit(2)
 
     outputfile_plu = outputfile + '_plu.csv'
     outputfile += '.csv'
@@ -151,18 +291,28 @@ def main(argv):
     logger.info('Output files are "{}"'.format(outputfile))
 
     with ExitStack() as s:
-        csv1 = s.enter_context(open(outputfile, 'w+', encoding='utf-8'))
-        csv2 = s.enter_context(open(outputfile_plu, 'w+', encoding='utf-8'))
+        csv1 = s.enter_context(open(outputfile, 'wb', buffering=OUTPUT_BUFFER_SIZE))
+        csv2 = s.enter_context(open(outputfile_plu, 'wb', buffering=OUTPUT_BUFFER_SIZE))
         processed = 0
         failed = []
         try:
-            for filename in tqdm(read_folder(basedir, year, month)):
-                logger.info('started processing file: {}'.format(filename))
+            filenames = list(read_folder(basedir, year, month))
+            if jobs == 1:
+                # process in this process, following files are read in background meanwhile
+                results = ((filename, partial(_process_content, content))
+                           for filename, content in read_ahead(filenames))
+            else:
+                executor = s.enter_context(ProcessPoolExecutor(max_workers=jobs, initializer=configure_logging))
+                # files are independent, results are collected in order so output stays deterministic
+                futures = [executor.submit(_process_file, filename) for filename in filenames]
+                results = ((filename, future.result) for filename, future in zip(filenames, futures))
+            for filename, result in tqdm(results, total=len(filenames)):
                 try:
-                    for lines in parse_csv(filename):
-                        doc = process_doc(lines)
-                        append_doc_to_csv(csv1, csv2, doc)
-                        processed += 1
+                    bills, items, count = result()
+                    csv1.write(bills)
+                    csv2.write(items)
+                    processed += count
+                    logger.info('processed file: {}'.format(filename))
                 except KeyboardInterrupt:
                     raise
                 except Exception as e:
@@ -178,20 +328,5 @@ def main(argv):
 
 
 if __name__ == '__main__':
-    # create logger
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-
-    # create console handler and set level to debug
-    ch = logging.StreamHandler(stream=sys.stdout)
-    ch.setLevel(logging.DEBUG)
-
-    # create formatter
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-    # add formatter to ch
-    ch.setFormatter(formatter)
-
-    # add ch to logger
-    logger.addHandler(ch)
+    configure_logging()
     main(sys.argv)